@@ -6,8 +6,8 @@ except ImportError:
     from distutils.core import setup
 
 classifiers = [
-    "Programming Language :: Python :: 2",
     "Programming Language :: Python :: 3",
+    "Programming Language :: Python :: 3 :: Only",
     "Intended Audience :: Developers",
     "License :: OSI Approved :: BSD License",
     "Topic :: Scientific/Engineering :: Visualization",
@@ -32,7 +32,12 @@ setup(
     long_description=long_description,
     license="BSD",
     classifiers=classifiers,
+    python_requires=">=3.7",
     install_requires=[
         "ipython",
-    ]
+        "importlib_metadata; python_version < '3.8'",
+    ],
+    extras_require={
+        "pdfium": ["pypdfium2", "Pillow"],
+    }
 )
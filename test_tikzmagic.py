@@ -0,0 +1,207 @@
+import os
+
+import pytest
+
+import tikzmagic
+from tikzmagic import (
+    TikzMagics, TikzRunner, _ImageCache, _fix_gnuplot_svg_size, clean_workdir, split_pictures)
+
+
+def make_runner(code=r'\draw (0,0) rectangle (1,1);', size='400,240',
+                plot_format='png', **kwargs):
+    return TikzRunner(code, '', '', None, size, 1, plot_format=plot_format,
+                      **kwargs)
+
+
+@pytest.mark.parametrize('plot_format', ['png', 'jpg', 'svg'])
+def test_cache_key_depends_on_size(plot_format):
+    small = make_runner(size='100,100', plot_format=plot_format)
+    large = make_runner(size='800,600', plot_format=plot_format)
+    assert (small._cache_key(small.compile_tikz_template())
+            != large._cache_key(large.compile_tikz_template()))
+
+
+def test_cache_key_depends_on_source_and_format():
+    png, svg = make_runner(plot_format='png'), make_runner(plot_format='svg')
+    code = png.compile_tikz_template()
+    assert png._cache_key(code) == make_runner()._cache_key(code)
+    assert png._cache_key(code) != png._cache_key(code + '%')
+    assert png._cache_key(code) != svg._cache_key(code)
+    assert png._cache_key(code) != make_runner(encoding='latin-1')._cache_key(code)
+
+
+def test_cache_key_is_none_without_cache():
+    runner = make_runner(use_cache=False)
+    assert runner._cache_key(runner.compile_tikz_template()) is None
+
+
+def test_fix_svg_size_replaces_width_and_height():
+    svg = b'<svg width="10pt" height="5pt" stroke-width="2" viewBox="0 0 10 5"/>'
+    assert (_fix_gnuplot_svg_size(svg, size=(400, 240))
+            == '<svg width="400px" height="240px" stroke-width="2" viewBox="0 0 10 5"/>')
+
+
+def test_fix_svg_size_keeps_xml_prolog():
+    svg = '<?xml version="1.0"?>\n<svg viewBox="0 0 10 5"><g/></svg>'
+    assert (_fix_gnuplot_svg_size(svg, size=(400, 240))
+            == '<?xml version="1.0"?>\n<svg width="400px" height="240px" '
+               'viewBox="0 0 10 5"><g/></svg>')
+
+
+def test_fix_svg_size_falls_back_to_viewbox():
+    svg = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0,0,10.5,5"/>'
+    assert (_fix_gnuplot_svg_size(svg)
+            == '<svg width="10px" height="5px" '
+               'xmlns="http://www.w3.org/2000/svg" viewBox="0,0,10.5,5"/>')
+
+
+def test_fix_svg_size_keeps_existing_size_without_given_size():
+    svg = '<svg width="10pt" height="5pt" viewBox="0 0 10 5"/>'
+    assert _fix_gnuplot_svg_size(svg) == svg
+
+
+def test_split_pictures():
+    cell = '\\draw (0,0);\n  \\newpage \r\n\\fill (1,1);\n\\newpage\n\n'
+    assert split_pictures(cell) == ['\\draw (0,0);', '\\fill (1,1);']
+
+
+def test_split_pictures_ignores_newpage_within_a_line():
+    cell = '\\node {a} \\newpage;'
+    assert split_pictures(cell) == [cell]
+
+
+def test_image_cache_evicts_least_recently_used():
+    cache = _ImageCache(maxsize=2)
+    cache.put('a', b'1')
+    cache.put('b', b'2')
+    assert cache.get('a') == b'1'
+    cache.put('c', b'3')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1'
+    assert cache.get('c') == b'3'
+
+
+def test_clean_workdir_removes_only_run_files(tmp_path):
+    for name in ['tikz.tex', 'tikz.log', 'tikz-2.png', 'tikz.svg', 'notes.txt', 'tikzpre.tex']:
+        (tmp_path / name).write_text('')
+    clean_workdir(str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == ['notes.txt', 'tikzpre.tex']
+
+
+@pytest.fixture
+def magics():
+    from IPython.core.interactiveshell import InteractiveShell
+    return TikzMagics(InteractiveShell.instance())
+
+
+def test_ensure_format_keeps_formats_per_header(magics, monkeypatch):
+    built = []
+    monkeypatch.setattr(tikzmagic, 'build_latex_format',
+                        lambda header, dirpath, engine: built.append(header) or True)
+    first = magics._ensure_format('a')
+    second = magics._ensure_format('b')
+    assert magics._ensure_format('a') == first
+    assert magics._ensure_format('b') == second
+    assert built == ['a', 'b']
+
+
+def test_ensure_format_remembers_failure(magics, monkeypatch):
+    built = []
+    monkeypatch.setattr(tikzmagic, 'build_latex_format',
+                        lambda header, dirpath, engine: built.append(header) or header != 'bad')
+    monkeypatch.setattr(tikzmagic, 'has_mylatexformat', lambda: True)
+    assert magics._ensure_format('bad') is None
+    assert magics._ensure_format('bad') is None
+    assert magics._ensure_format('good') is not None
+    assert built == ['bad', 'good']
+
+
+def test_ensure_format_stops_without_mylatexformat(magics, monkeypatch, capsys):
+    built = []
+    monkeypatch.setattr(tikzmagic, 'build_latex_format',
+                        lambda header, dirpath, engine: built.append(header) and False)
+    monkeypatch.setattr(tikzmagic, 'has_mylatexformat', lambda: False)
+    assert magics._ensure_format('a') is None
+    assert magics._ensure_format('b', engine='latex') is None
+    assert built == ['a']
+    assert capsys.readouterr().err.count('mylatexformat is not installed') == 1
+
+
+@pytest.mark.skipif(tikzmagic.pdfium is None, reason='needs pypdfium2 and Pillow')
+def test_convert_pdf_pages_reports_errors(tmp_path, capsys):
+    (tmp_path / 'tikz.pdf').write_bytes(b'not a pdf')
+    tikzmagic._convert_pdf_pages(str(tmp_path), 'png', [1, 2], (10, 10))
+    assert capsys.readouterr().err.count('PDF rendering failed') == 2
+
+
+def test_svg_falls_back_to_pdflatex_when_latex_fails(tmp_path, monkeypatch):
+    def run_latex(code, dirpath, encoding, fmt_dir, engine):
+        if engine == 'latex':
+            return '! LaTeX Error: Unknown graphics extension: .png.'
+        (tmp_path / 'tikz.svg').write_text('<svg viewBox="0 0 1 1"/>')
+        return None
+
+    monkeypatch.setattr(tikzmagic, '_HAS_DVISVGM', True)
+    monkeypatch.setattr(tikzmagic, 'run_latex', run_latex)
+    monkeypatch.setattr(tikzmagic, '_convert_img_format', lambda *args: None)
+    runner = make_runner(plot_format='svg', img_save_path=None, use_cache=False,
+                         workdir=str(tmp_path))
+    ((_, data),) = runner.generate_plots(runner.compile_tikz_template())
+    assert data['image/svg+xml'] == '<svg width="400px" height="240px" viewBox="0 0 1 1"/>'
+
+
+def test_convert_pdf_pages_skips_pool_for_one_worker(monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError('no pool expected for a single worker')
+
+    converted = []
+    monkeypatch.setattr(tikzmagic.os, 'cpu_count', lambda: 1)
+    monkeypatch.setattr(tikzmagic.concurrent.futures, 'ThreadPoolExecutor', no_pool)
+    monkeypatch.setattr(tikzmagic, '_convert_pdf_to_svg',
+                        lambda dirpath, page, out: converted.append(out))
+    assert (tikzmagic._convert_pdf_pages('dir', 'svg', [1, 2], (10, 10))
+            == ['dir/tikz-1.svg', 'dir/tikz-2.svg'])
+    assert converted == ['tikz-1.svg', 'tikz-2.svg']
+
+
+@pytest.mark.parametrize('plot_format', ['png', 'jpg'])
+def test_header_leaves_rasterizing_to_pdfium(plot_format, monkeypatch):
+    monkeypatch.setattr(tikzmagic, 'pdfium', object())
+    assert 'convert=' not in make_runner(plot_format=plot_format).compile_tikz_header()
+    monkeypatch.setattr(tikzmagic, 'pdfium', None)
+    assert 'convert=' in make_runner(plot_format=plot_format).compile_tikz_header()
+
+
+def test_batch_publishes_cached_pictures_when_latex_fails(tmp_path, monkeypatch):
+    published = []
+    monkeypatch.setattr(tikzmagic, 'run_latex', lambda *args: '! Undefined control sequence.')
+    monkeypatch.setattr(tikzmagic, 'publish_display_data',
+                        lambda **kwargs: published.append(kwargs['data']))
+    runner = make_runner(img_save_path=None, memcache=_ImageCache(),
+                         cache_dir=str(tmp_path), workdir=str(tmp_path))
+    good, bad = r'\draw (0,0) -- (1,1);', r'\drw (0,0);'
+    runner._store_in_cache(
+        runner._cache_key(runner.compile_tikz_template(good, engine='pdflatex')), b'PNG')
+
+    display_data = runner.generate_batch_plots([good, bad])
+    assert published == [{'text/plain': '! Undefined control sequence.'}]
+    assert [data for _, data in display_data] == [{'image/png': b'PNG'}]
+
+
+def test_dry_run_does_no_filesystem_work(magics, monkeypatch, capsys):
+    def build_latex_format(*args, **kwargs):
+        raise AssertionError('no format expected for a dry run')
+
+    monkeypatch.setattr(tikzmagic, 'build_latex_format', build_latex_format)
+    magics.tikz('-d -s abc', r'\draw (0,0) -- (1,1);')
+    magics.tikz_batch('-d', '\\draw (0,0) -- (1,1);\n\\newpage\n\\fill (0,0) circle (1);')
+    assert magics._workdir is None
+    assert not magics._fmt_dirs
+    out = capsys.readouterr().out
+    assert out.count('\\begin{document}') == 2
+    assert '\\draw (0,0) -- (1,1);' in out and '\\fill (0,0) circle (1);' in out
+
+
+def test_invalid_size_fails_without_dry_run(magics):
+    with pytest.raises(ValueError):
+        magics.tikz('-s abc', r'\draw (0,0) -- (1,1);')
@@ -25,29 +25,62 @@ Usage
 
 {TIKZ_DOC}
 
+``%%tikz_batch``
+
+{TIKZ_BATCH_DOC}
+
 """
 
 from __future__ import print_function
 
 import os
+import re
 import sys
+import atexit
 import shutil
+import pathlib
+import hashlib
+import collections
 import tempfile
+import textwrap
 import contextlib
 import subprocess
-from xml.dom import minidom
+import concurrent.futures
 
 from IPython.core.displaypub import publish_display_data
-from IPython.core.magic import Magics, magics_class, line_cell_magic, needs_local_scope
+from IPython.core.magic import (
+    Magics, magics_class, line_cell_magic, cell_magic, needs_local_scope)
 from IPython.core.magic_arguments import argument, magic_arguments, parse_argstring
 from IPython.testing.skipdoctest import skip_doctest
 
 try:
-    import pkg_resources  # part of setuptools
-    __version__ = pkg_resources.require("ipython-tikzmagic")[0].version
+    import importlib.metadata as importlib_metadata
+except ImportError:  # Python 3.7
+    import importlib_metadata
+
+try:
+    # optional, converts PNGs to JPEG in-process instead of running ImageMagick
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    # optional, renders PDF pages in-process instead of running ImageMagick
+    import pypdfium2 as pdfium
 except ImportError:
+    pdfium = None
+
+if Image is None:
+    # pages rendered by pdfium are handed over as PIL images
+    pdfium = None
+
+
+try:
+    __version__ = importlib_metadata.version("ipython-tikzmagic")
+except importlib_metadata.PackageNotFoundError:
     __version__ = 'unknown'
 
+
 _MIME_TYPES = {
     'png': 'image/png',
     'svg': 'image/svg+xml',
@@ -55,6 +88,9 @@ _MIME_TYPES = {
     'jpeg': 'image/jpeg'
 }
 
+_DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'ipython-tikzmagic')
+
 
 def get_mime_type(img_format):
     return _MIME_TYPES.get(img_format, 'image/%s' % img_format)
@@ -66,44 +102,170 @@ def split_csv_args(arg_string):
             if name.strip()]
 
 
-@contextlib.contextmanager
-def working_directory(path):
-    """A context manager which changes the working directory to the given
-    path, and then changes it back to its previous value on exit.
+def split_pictures(cell):
+    """Split a cell into the code of separate pictures, delimited by lines
+    containing only ``\\newpage``.
+    """
+    return [code.strip()
+            for code in re.split(r'^[ \t]*\\newpage[ \t\r]*$', cell, flags=re.MULTILINE)
+            if code.strip()]
 
+
+def _tempdir_root():
+    """Returns the RAM-backed `/dev/shm` if it is usable, so that the
+    intermediate LaTeX files never hit the disk, else None (the default
+    temporary directory).
     """
-    prev_cwd = os.getcwd()
-    os.chdir(path)
-    try:
-        yield prev_cwd
-    finally:
-        os.chdir(prev_cwd)
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
 
 
 @contextlib.contextmanager
 def make_tempdir():
-    """This sort of thing exists in Py3 as `tempfile.TemporaryDirectory`,
-    but we roll our own here for Py2 compatibility.
+    """Like `tempfile.TemporaryDirectory`, but created under `/dev/shm`
+    when possible, see `_tempdir_root`.
     """
-    tempdir_path = tempfile.mkdtemp().replace('\\', '/')
+    tempdir_path = tempfile.mkdtemp(dir=_tempdir_root()).replace('\\', '/')
     try:
         yield tempdir_path
     finally:
         shutil.rmtree(tempdir_path)
 
 
-def run_latex(code, dirpath, encoding='utf-8'):
+# the files a run leaves in its working directory, see `clean_workdir`
+_WORKDIR_FILE_RE = re.compile(r'^tikz(-\d+)?\.(tex|aux|log|dvi|pdf|png|svg|jpg|jpeg)$')
+
+
+def clean_workdir(dirpath):
+    """Remove the files of a previous run from a reused working directory,
+    so that a failed run can not pick up stale images.
+    """
+    for name in os.listdir(dirpath):
+        if _WORKDIR_FILE_RE.match(name):
+            os.unlink(os.path.join(dirpath, name))
+
+
+_FORMAT_NAME = 'tikzmagic'
+
+# SVGs are rendered from DVI by dvisvgm if available, see `_renders_svg_from_dvi`
+_HAS_DVISVGM = shutil.which('latex') is not None and shutil.which('dvisvgm') is not None
+
+# Templates of the generated document, see `TikzRunner.compile_tikz_template`.
+# The header is the part precompiled by `build_latex_format`.
+_TEX_HEADER_TEMPLATE = (
+    '\\documentclass[{class_options}]{{standalone}}\n'
+    '{driver}'
+    '\\usepackage{{tikz}}\n'
+    '{packages}'
+    '\\usetikzlibrary{{{libs}}}')
+
+# Everything up to \endofdump is skipped when compiling against the
+# precompiled format; without the format, the \csname is a no-op.
+_TEX_TEMPLATE = (
+    '{header}\n'
+    '\\csname endofdump\\endcsname\n'
+    '{preamble}'
+    '\\begin{{document}}\n'
+    '{pictures}\n'
+    '\\end{{document}}')
+
+_TIKZPICTURE_TEMPLATE = (
+    '\\begin{{tikzpicture}}[scale={scale}]\n'
+    '{body}\n'
+    '\\end{{tikzpicture}}')
+
+# Stop at the first error instead of prompting, the log is published instead
+_LATEX_OPTIONS = ['-interaction=batchmode', '-halt-on-error']
+
+
+def _run_command(name, argv, show_output=True, **kwargs):
+    """Run an external program without a shell. Its output is captured and
+    only printed if it fails (and `show_output` is set).
+
+    Returns True if the program ran successfully, else False.
+
+    """
+    try:
+        result = subprocess.run(argv, capture_output=True, check=False, **kwargs)
+    except OSError as e:
+        print(name, "execution failed:", e, file=sys.stderr)
+        return False
+
+    if result.returncode != 0:
+        if result.returncode < 0:
+            print(name, "terminated with signal", -result.returncode, file=sys.stderr)
+        else:
+            print(name, "exited with status", result.returncode, file=sys.stderr)
+
+        if show_output:
+            output = (result.stdout + result.stderr).decode('utf-8', 'replace')
+            print(output.strip(), file=sys.stderr)
+        return False
+
+    return True
+
+
+def run_latex(code, dirpath, encoding='utf-8', fmt_dir=None, engine='pdflatex'):
+    if fmt_dir is not None:
+        # load the precompiled preamble, see `build_latex_format`
+        code = '%%&%s\n%s' % (_FORMAT_NAME, code)
+
+    # The source is written to a file rather than piped to pdflatex: TeX reads
+    # piped input as terminal input, which is fatal in batchmode, would take
+    # error responses from the source in the other modes, and is not seen by
+    # the `%&` format line. On tmpfs (see `make_tempdir`) the file is cheap.
     with open(dirpath + '/tikz.tex', 'w', encoding=encoding) as f:
         f.write(code)
 
-    with working_directory(dirpath) as current_dir:
-        # in case of error return LaTeX log
-        if not _convert_tikz_latex(current_dir):
-            return _read_tikz_log()
+    # in case of error return LaTeX log, it is not read on success
+    if not _convert_tikz_latex(dirpath, fmt_dir, engine):
+        return _read_tikz_log(dirpath + '/tikz.log')
 
 
-def _convert_tikz_latex(current_dir):
-    """Returns True if conversion is successful, else False."""
+def build_latex_format(header, dirpath, encoding='utf-8', engine='pdflatex'):
+    """Dump the given preamble into a LaTeX format file in `dirpath`.
+
+    Loading the format is much faster than processing the preamble (TikZ in
+    particular), so documents starting with this preamble can be compiled
+    against the format instead. Requires the `mylatexformat` package.
+
+    Returns True if the format was built, else False.
+
+    """
+    with open(dirpath + '/tikzpre.tex', 'w', encoding=encoding) as f:
+        f.write(header + '\n\\endofdump\n\\begin{document}\n\\end{document}\n')
+
+    success = _run_command(
+        "LaTeX format generation",
+        [engine, '-ini', '--shell-escape'] + _LATEX_OPTIONS +
+        ['-output-directory', dirpath, '-jobname=' + _FORMAT_NAME,
+         '&' + engine, 'mylatexformat.ltx', 'tikzpre.tex'],
+        show_output=False, cwd=dirpath, env=_latex_env(os.getcwd()))
+
+    return success and os.path.isfile('%s/%s.fmt' % (dirpath, _FORMAT_NAME))
+
+
+def has_mylatexformat():
+    """Returns False if kpsewhich can not find the mylatexformat package,
+    which `build_latex_format` needs. Without kpsewhich it is assumed to be
+    installed.
+    """
+    if shutil.which('kpsewhich') is None:
+        return True
+
+    try:
+        result = subprocess.run(
+            ['kpsewhich', 'mylatexformat.ltx'], capture_output=True, check=False)
+    except OSError:
+        return True
+    return result.returncode == 0 and bool(result.stdout.strip())
+
+
+def _latex_env(current_dir, fmt_dir=None):
+    """Returns the environment for running LaTeX from a temporary directory
+    on behalf of a notebook in `current_dir`.
+    """
     # Set the TEXINPUTS environment variable, which allows the tikz code
     # to reference files relative to the notebook (includes, packages, ...)
     env = os.environ.copy()
@@ -114,22 +276,25 @@ def _convert_tikz_latex(current_dir):
         # note that the trailing double pathsep will insert the standard
         # search path (otherwise we would lose access to all packages)
 
-    try:
-        retcode = subprocess.call(
-            "pdflatex --shell-escape tikz.tex", shell=True, env=env)
+    if fmt_dir is not None:
+        # as above, the trailing pathsep keeps the standard formats available
+        env['TEXFORMATS'] = fmt_dir + os.pathsep + env.get('TEXFORMATS', '')
 
-        if retcode != 0:
-            print("LaTeX terminated with signal", -retcode, file=sys.stderr)
-            return False
-    except OSError as e:
-        print("LaTeX execution failed:", e, file=sys.stderr)
-        return False
+    return env
 
-    return True
+
+def _convert_tikz_latex(dirpath, fmt_dir=None, engine='pdflatex'):
+    """Returns True if conversion is successful, else False."""
+    # the output is not shown on failure, the log is published instead
+    return _run_command(
+        "LaTeX",
+        [engine, '--shell-escape'] + _LATEX_OPTIONS +
+        ['-output-directory', dirpath, 'tikz.tex'],
+        show_output=False, cwd=dirpath, env=_latex_env(os.getcwd(), fmt_dir))
 
 
-def _read_tikz_log(log_path='tikz.log', encoding='latin-1'):
-    """Returns log from `tikz.log` if that file exists, else None."""
+def _read_tikz_log(log_path, encoding='latin-1'):
+    """Returns log from `log_path` if that file exists, else None."""
     try:
         with open(log_path, 'r', encoding=encoding) as f:
             return f.read()
@@ -138,34 +303,140 @@ def _read_tikz_log(log_path='tikz.log', encoding='latin-1'):
         return None
 
 
-def _convert_img_format(plot_dir, plot_format):
-    if plot_format == 'jpg' or plot_format == 'jpeg':
+def _renders_raster_from_pdf(plot_format):
+    """PNGs and JPEGs are rendered from the PDF in-process when pdfium is
+    available, instead of by ImageMagick through the standalone class.
+    """
+    return pdfium is not None and plot_format in {'png', 'jpg', 'jpeg'}
+
+
+def _renders_svg_from_dvi(plot_format):
+    """SVGs are compiled with latex to DVI and converted by dvisvgm when it
+    is available, instead of going through a PDF and pdf2svg.
+    """
+    return _HAS_DVISVGM and plot_format == 'svg'
+
+
+def _convert_img_format(plot_dir, plot_format, size, engine='pdflatex'):
+    if plot_format == 'svg' and engine == 'latex':
+        _convert_dvi_to_svg(plot_dir)
+    elif _renders_raster_from_pdf(plot_format):
+        _convert_pdf_to_raster(plot_dir, 1, 'tikz.%s' % plot_format, size)
+    elif plot_format == 'jpg' or plot_format == 'jpeg':
         _convert_png_to_jpg(plot_dir)
     elif plot_format == 'svg':
         _convert_pdf_to_svg(plot_dir)
 
 
-def _convert_pdf_to_svg(dirpath):
-    with working_directory(dirpath):
-        try:
-            retcode = subprocess.call("pdf2svg tikz.pdf tikz.svg", shell=True)
-            if retcode != 0:
-                print("pdf2svg terminated with signal", -retcode, file=sys.stderr)
-        except OSError as e:
-            print("pdf2svg execution failed:", e, file=sys.stderr)
+def _convert_dvi_to_svg(dirpath):
+    # --no-fonts draws glyphs as paths, so the SVG does not depend on fonts
+    _run_command("dvisvgm", [
+        'dvisvgm', '--no-fonts', '--exact-bbox', 'tikz.dvi', '-o', 'tikz.svg'],
+        cwd=dirpath)
+
+
+def _convert_pdf_to_svg(dirpath, page=1, out='tikz.svg'):
+    _run_command("pdf2svg", ['pdf2svg', 'tikz.pdf', out, str(page)], cwd=dirpath)
 
 
 def _convert_png_to_jpg(dirpath):
-    with working_directory(dirpath):
+    if Image is not None:
         try:
-            retcode = subprocess.call(
-                "convert tikz.png -quality 100 -background white -flatten tikz.jpg",
-                shell=True)
+            _flatten(Image.open(dirpath + '/tikz.png')).save(
+                dirpath + '/tikz.jpg', quality=100)
+        except IOError as e:
+            print("JPEG conversion failed:", e, file=sys.stderr)
+        return
 
-            if retcode != 0:
-                print("convert terminated with signal", -retcode, file=sys.stderr)
-        except OSError as e:
-            print("convert execution failed:", e, file=sys.stderr)
+    _run_command("convert", [
+        'convert', 'tikz.png', '-quality', '100', '-background', 'white',
+        '-flatten', 'tikz.jpg'], cwd=dirpath)
+
+
+def _convert_pdf_to_raster(dirpath, page, out, size):
+    """Rasterize a page of `tikz.pdf` the same way the standalone class does
+    for its convert option. The format is determined by the extension of `out`.
+    """
+    if pdfium is not None:
+        try:
+            image = _render_pdf_page(dirpath + '/tikz.pdf', page, size)
+            if out.endswith(('.jpg', '.jpeg')):
+                image = _flatten(image)
+            image.save('%s/%s' % (dirpath, out), quality=100)
+        except (IOError, pdfium.PdfiumError) as e:
+            print("PDF rendering failed:", e, file=sys.stderr)
+        return
+
+    command = ['convert', '-density', '300', 'tikz.pdf[%d]' % (page - 1),
+               '-resize', '%dx%d' % size]
+    if out.endswith(('.jpg', '.jpeg')):
+        command += ['-quality', '100', '-background', 'white', '-flatten']
+
+    _run_command("convert", command + [out], cwd=dirpath)
+
+
+def _render_pdf_page(pdf_path, page, size, density=300):
+    """Render a page of a PDF with pdfium and scale it to fit into `size`,
+    like ImageMagick's ``-resize``. Returns a PIL image with transparent
+    background.
+    """
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        bitmap = pdf[page - 1].render(scale=density / 72.0, fill_color=(255, 255, 255, 0))
+        image = bitmap.to_pil()
+    finally:
+        pdf.close()
+
+    ratio = min(float(size[0]) / image.width, float(size[1]) / image.height)
+    return image.resize(
+        (max(1, int(round(image.width * ratio))), max(1, int(round(image.height * ratio)))),
+        Image.LANCZOS)
+
+
+def _flatten(image):
+    """Flatten a PIL image onto a white background, for formats without alpha."""
+    image = image.convert('RGBA')
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+def _convert_pdf_pages(dirpath, plot_format, pages, size):
+    """Convert the given pages of a multi-page `tikz.pdf`, see
+    `_convert_pdf_page`. Returns the paths of the generated images.
+
+    The external converters run as subprocesses, so their pages are
+    converted in parallel from threads, up to the number of CPUs at a time.
+    pdfium renders in-process and is not thread-safe, and is fast enough to
+    render the pages one after another.
+    """
+    pages = list(pages)
+    max_workers = min(len(pages), os.cpu_count() or 1)
+    if max_workers <= 1 or (plot_format != 'svg' and pdfium is not None):
+        return [_convert_pdf_page(dirpath, page, plot_format, size) for page in pages]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(
+            _convert_pdf_page,
+            [dirpath] * len(pages), pages,
+            [plot_format] * len(pages), [size] * len(pages)))
+
+
+def _convert_pdf_page(dirpath, page, plot_format, size):
+    """Convert page `page` (starting at 1) of `tikz.pdf` to
+    `tikz-<page>.<plot_format>` and return the path of the image.
+    """
+    image_filename = 'tikz-%d.%s' % (page, plot_format)
+    if plot_format == 'svg':
+        _convert_pdf_to_svg(dirpath, page, image_filename)
+    else:
+        _convert_pdf_to_raster(dirpath, page, image_filename, size)
+
+    return '%s/%s' % (dirpath, image_filename)
+
+
+_SVG_TAG_RE = re.compile(r'<svg\b[^>]*>')
+_SVG_SIZE_ATTR_RE = re.compile(r"""\s(?:width|height)\s*=\s*(?:"[^"]*"|'[^']*')""")
 
 
 def _fix_gnuplot_svg_size(image, size=None):
@@ -173,6 +444,10 @@ def _fix_gnuplot_svg_size(image, size=None):
     these to be the same as the viewBox, so that the browser
     scales the image correctly.
 
+    Only the opening `<svg>` tag is patched, the SVG is parsed just when the
+    viewBox has to be looked up (no `size` given). SVGs which already have
+    both attributes are then returned as they are.
+
     Parameters
     ----------
     image : str|bytes
@@ -180,24 +455,110 @@ def _fix_gnuplot_svg_size(image, size=None):
     size : tuple of int
         Image width, height.
 
+    Returns
+    -------
+    str
+        SVG data with the new width and height.
+
     """
-    (svg,) = minidom.parseString(image).getElementsByTagName('svg')
-    viewbox = svg.getAttribute('viewBox').split(' ')
+    if isinstance(image, bytes):
+        image = image.decode('utf-8')
+
+    match = _SVG_TAG_RE.search(image)
+    if match is None:
+        return image
 
     if size is not None:
         width, height = size
+    elif len(_SVG_SIZE_ATTR_RE.findall(match.group(0))) == 2:
+        return image
     else:
-        width, height = viewbox[2:]
+        from xml.dom import minidom  # only needed for this rare case
+        (svg,) = minidom.parseString(image).getElementsByTagName('svg')
+        viewbox = svg.getAttribute('viewBox').replace(',', ' ').split()
+        width, height = (float(value) for value in viewbox[2:])
 
-    svg.setAttribute('width', '%dpx' % width)
-    svg.setAttribute('height', '%dpx' % height)
-    return svg.toxml()
+    tag = _SVG_SIZE_ATTR_RE.sub('', match.group(0))
+    tag = '<svg width="%dpx" height="%dpx"%s' % (width, height, tag[len('<svg'):])
+    return image[:match.start()] + tag + image[match.end():]
+
+
+class _ImageCache(object):
+    """A least recently used mapping of cache keys to image data, which
+    keeps at most `maxsize` images in memory.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._images = collections.OrderedDict()
+
+    def get(self, key):
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+        return image
+
+    def put(self, key, image):
+        self._images[key] = image
+        self._images.move_to_end(key)
+        while len(self._images) > self.maxsize:
+            self._images.popitem(last=False)
+
+
+# Arguments of both %tikz and %%tikz_batch, in the order of the help text
+_TIKZ_ARGUMENTS = [
+    argument(
+        '-sc', '--scale', action='store', type=str, default=1,
+        help='Scaling factor of plots. Default is "--scale 1".'),
+    argument(
+        '-s', '--size', action='store', type=str, default='400,240',
+        help='Pixel size of plots, "width,height". Default is "--size 400,240".'),
+    argument(
+        '-f', '--format', action='store', type=str, default='png',
+        help='Plot format (png, svg or jpg).'),
+    argument(
+        '-e', '--encoding', action='store', type=str, default='utf-8',
+        help='Text encoding, e.g., -e utf-8.'),
+    argument(
+        '-x', '--preamble', action='store', type=str, default='',
+        help='LaTeX preamble to insert before tikz figure, e.g., '
+             '-x $preamble, with preamble some string variable.'),
+    argument(
+        '-p', '--package', action='store', type=str, default='',
+        help='LaTeX packages to load, separated by comma, e.g., -p pgfplots,textcomp.'),
+    argument(
+        '-l', '--library', action='store', type=str, default='',
+        help='TikZ libraries to load, separated by comma, e.g., -l matrix,arrows.'),
+    argument(
+        '-S', '--save', action='store', type=str, default=None,
+        help='Save a copy to file, e.g., -S filename. Default is None'),
+    argument(
+        '-d', '--dry-run', action='store_true', default=False,
+        help='Output the LaTeX code that will be generated.'),
+    argument(
+        '--no-cache', action='store_true', default=False,
+        help='Always run LaTeX, bypassing the cache of compiled images.'),
+    argument(
+        '-C', '--cache-dir', action='store', type=str, default=None,
+        help='Directory for cached images. '
+             'Default is "--cache-dir ~/.cache/ipython-tikzmagic".'),
+]
+
+
+def tikz_arguments(func):
+    """Add the common TikZ arguments to a magic function."""
+    for arg in reversed(_TIKZ_ARGUMENTS):
+        func = arg(func)
+    return func
 
 
 @magics_class
 class TikzMagics(Magics):
     """A set of magics useful for creating figures with TikZ."""
 
+    # precompiled formats kept at a time, each takes a few megabytes
+    _MAX_FORMATS = 4
+
     def __init__(self, shell):
         """
         Parameters
@@ -206,37 +567,64 @@ class TikzMagics(Magics):
 
         """
         super(TikzMagics, self).__init__(shell)
+        # (header, engine) -> directory of the format file, most recently
+        # used last (see `_ensure_format`)
+        self._fmt_dirs = collections.OrderedDict()
+        # (header, engine) of formats that failed to build, and whether
+        # formats can not be built at all because mylatexformat is missing
+        self._fmt_failures = set()
+        self._fmt_unavailable = False
+        # compiled images of this session, in front of the cache on disk
+        self._memcache = _ImageCache(maxsize=128)
+        # one working directory for all runs, instead of a new one per cell,
+        # created on first use (see `_get_workdir`)
+        self._workdir = None
+
+    def _get_workdir(self):
+        if self._workdir is None:
+            self._workdir = tempfile.mkdtemp(dir=_tempdir_root()).replace('\\', '/')
+            atexit.register(shutil.rmtree, self._workdir, ignore_errors=True)
+        return self._workdir
+
+    def _ensure_format(self, header, engine='pdflatex'):
+        """Returns the directory of a LaTeX format precompiled from
+        `header` for `engine`, or None if no format could be built.
+
+        The formats of the last few headers are kept, so that switching back
+        and forth between options does not rebuild them every time. A header
+        that failed to build, e.g. because of a misspelled package, is not
+        retried; if mylatexformat is missing, no formats are built at all.
+        """
+        fmt_key = (header, engine)
+        if self._fmt_unavailable or fmt_key in self._fmt_failures:
+            return None
+
+        fmt_dir = self._fmt_dirs.get(fmt_key)
+        if fmt_dir is not None:
+            self._fmt_dirs.move_to_end(fmt_key)
+            return fmt_dir
+
+        fmt_dir = tempfile.mkdtemp(dir=_tempdir_root()).replace('\\', '/')
+        atexit.register(shutil.rmtree, fmt_dir, ignore_errors=True)
+        if not build_latex_format(header, fmt_dir, engine=engine):
+            shutil.rmtree(fmt_dir, ignore_errors=True)
+            if has_mylatexformat():
+                self._fmt_failures.add(fmt_key)
+            else:
+                print("Could not precompile the LaTeX preamble "
+                      "(mylatexformat is not installed)", file=sys.stderr)
+                self._fmt_unavailable = True
+            return None
+
+        self._fmt_dirs[fmt_key] = fmt_dir
+        while len(self._fmt_dirs) > self._MAX_FORMATS:
+            _, old_fmt_dir = self._fmt_dirs.popitem(last=False)
+            shutil.rmtree(old_fmt_dir, ignore_errors=True)
+        return fmt_dir
 
     @skip_doctest
     @magic_arguments()
-    @argument(
-        '-sc', '--scale', action='store', type=str, default=1,
-        help='Scaling factor of plots. Default is "--scale 1".')
-    @argument(
-        '-s', '--size', action='store', type=str, default='400,240',
-        help='Pixel size of plots, "width,height". Default is "--size 400,240".')
-    @argument(
-        '-f', '--format', action='store', type=str, default='png',
-        help='Plot format (png, svg or jpg).')
-    @argument(
-        '-e', '--encoding', action='store', type=str, default='utf-8',
-        help='Text encoding, e.g., -e utf-8.')
-    @argument(
-        '-x', '--preamble', action='store', type=str, default='',
-        help='LaTeX preamble to insert before tikz figure, e.g., '
-             '-x $preamble, with preamble some string variable.')
-    @argument(
-        '-p', '--package', action='store', type=str, default='',
-        help='LaTeX packages to load, separated by comma, e.g., -p pgfplots,textcomp.')
-    @argument(
-        '-l', '--library', action='store', type=str, default='',
-        help='TikZ libraries to load, separated by comma, e.g., -l matrix,arrows.')
-    @argument(
-        '-S', '--save', action='store', type=str, default=None,
-        help='Save a copy to file, e.g., -S filename. Default is None')
-    @argument(
-        '-d', '--dry-run', action='store_true', default=False,
-        help='Output the LaTeX code that will be generated.')
+    @tikz_arguments
     @needs_local_scope
     @argument('code', nargs='*')
     @line_cell_magic
@@ -284,32 +672,87 @@ class TikzMagics(Magics):
         else:
             code = code_from_args + cell
 
-        runner = TikzRunner(
+        self._make_runner(code, args).run()
+
+    @skip_doctest
+    @magic_arguments()
+    @tikz_arguments
+    @cell_magic
+    def tikz_batch(self, line, cell):
+        r"""Run several TikZ pictures in a single LaTeX run and plot results.
+
+        The pictures are separated by lines containing only ``\newpage``::
+
+            In [22]: %%tikz_batch -f svg
+                ...: \draw (0,0) rectangle (1,1);
+                ...: \newpage
+                ...: \filldraw (0.5,0.5) circle (.1);
+
+        Each picture is published as a separate output of the cell. All the
+        arguments of %tikz apply to every picture; when saving with -S, the
+        number of the picture is appended to the file name.
+        """
+        args = parse_argstring(self.tikz_batch, line)
+        self._make_runner(cell, args).run_batch(split_pictures(cell))
+
+    def _make_runner(self, code, args):
+        # a dry run only prints the LaTeX code and must not touch the filesystem
+        workdir = None if args.dry_run else self._get_workdir()
+        return TikzRunner(
             code, args.package, args.library, args.preamble, args.size, args.scale,
             plot_format=args.format, encoding=args.encoding,
-            img_save_path=args.save, dry_run=args.dry_run)
-        runner.run()
+            img_save_path=args.save, dry_run=args.dry_run,
+            use_cache=not args.no_cache, cache_dir=args.cache_dir,
+            format_provider=self._ensure_format, memcache=self._memcache,
+            workdir=workdir)
 
 
 class TikzRunner(object):
     """Run Tikz code to compile images."""
 
     def __init__(self, code, latex_packages, tikz_libraries, preamble, size, scale,
-                 plot_format='svg', encoding='utf-8', img_save_path='', dry_run=False):
+                 plot_format='svg', encoding='utf-8', img_save_path='', dry_run=False,
+                 use_cache=True, cache_dir=None, format_provider=None,
+                 memcache=None, workdir=None):
         self.code = code
         self.tikz_libraries = split_csv_args(tikz_libraries)
         self.latex_packages = split_csv_args(latex_packages)
         self.preamble = preamble
-        self.width, self.height = map(int, split_csv_args(size))
+        try:
+            self.width, self.height = map(int, split_csv_args(size))
+        except ValueError:
+            if not dry_run:
+                raise
+            # the size is only printed, so a dry run shows it as given
+            self.width, self.height = (split_csv_args(size) + [''] * 2)[:2]
         self.scale = scale
 
         self.plot_format = plot_format
         self.encoding = encoding
         self.img_save_path = img_save_path
         self.dry_run = dry_run
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir or _DEFAULT_CACHE_DIR
+        self.format_provider = format_provider
+        self.memcache = memcache
+        self.workdir = workdir
+        self._engine = 'latex' if _renders_svg_from_dvi(self.plot_format) else 'pdflatex'
 
         self._key = 'TikZMagic.Tikz'
 
+        # parts of the document that are the same for every picture
+        add_params = ""
+        if self.plot_format in {'png', 'jpg', 'jpeg'}:
+            add_params += "density=300,"
+        self._convert_args = '%ssize=%sx%s,outext=.png' % (add_params, self.width, self.height)
+        self._packages_tex = ''.join('\\usepackage{%s}\n' % pkg for pkg in self.latex_packages)
+        self._libraries_tex = ','.join(self.tikz_libraries)
+        if self.preamble is not None:
+            # the strip allows users to string-escape spacing
+            self._preamble_tex = self.preamble.strip("'\"") + '\n'
+        else:
+            self._preamble_tex = ''
+
     def run(self):
         compiled_code = self.compile_tikz_template()
         if self.dry_run:
@@ -317,8 +760,17 @@ class TikzRunner(object):
         else:
             self._run_and_display(compiled_code)
 
+    def run_batch(self, code_list):
+        """Compile all pictures in `code_list` with a single LaTeX run."""
+        if self.dry_run:
+            print(self.compile_tikz_batch_template(code_list))
+        else:
+            self._display(self.generate_batch_plots(code_list))
+
     def _run_and_display(self, compiled_code):
-        display_data = self.generate_plots(compiled_code)
+        self._display(self.generate_plots(compiled_code))
+
+    def _display(self, display_data):
         for tag, disp_d in display_data:
             if self.plot_format == 'svg':
                 # isolate data in an iframe, to prevent clashing glyph declarations in SVG
@@ -326,89 +778,248 @@ class TikzRunner(object):
             else:
                 publish_display_data(source=tag, data=disp_d, metadata=None)
 
-    def compile_tikz_template(self):
-        add_params = ""
-        if self.plot_format in {'png', 'jpg', 'jpeg'}:
-            add_params += "density=300,"
+    def compile_tikz_header(self, batch=False, engine=None):
+        """Returns the part of the preamble that is precompiled into a
+        LaTeX format, see `build_latex_format`. `engine` defaults to the
+        engine chosen for the plot format.
+        """
+        if engine is None:
+            engine = self._engine
+
+        driver = ''
+        if batch:
+            # one page per tikzpicture, converted page by page afterwards
+            class_options = 'tikz,border=0pt'
+        elif _renders_raster_from_pdf(self.plot_format):
+            # no convert run by the class, see `_convert_img_format`
+            class_options = 'border=0pt'
+        elif engine == 'latex':
+            class_options = 'border=0pt'
+            # pgf has to emit SVG specials instead of PostScript into the DVI
+            driver = '\\def\\pgfsysdriver{pgfsys-dvisvgm.def}\n'
+        else:
+            class_options = 'convert={%s},border=0pt' % self._convert_args
 
-        kwargs = {
-            'add_params': add_params,
-            'width': self.width,
-            'height': self.height,
-            'scale': self.scale,
-        }
+        return _TEX_HEADER_TEMPLATE.format(
+            class_options=class_options, driver=driver,
+            packages=self._packages_tex, libs=self._libraries_tex)
 
-        convert_args = '%(add_params)ssize=%(width)sx%(height)s,outext=.png' % kwargs
-        tex = ['\\documentclass[convert={%s},border=0pt]{standalone}' % convert_args,
-               '\\usepackage{tikz}']
+    def compile_tikz_template(self, code=None, engine=None):
+        if code is None:
+            code = self.code
+        return self._compile_document(self.compile_tikz_header(engine=engine), [code])
 
-        for pkg in self.latex_packages:
-            tex.append('\\usepackage{%s}' % pkg)
+    def compile_tikz_batch_template(self, code_list):
+        return self._compile_document(self.compile_tikz_header(batch=True), code_list)
 
-        tex.append('\\usetikzlibrary{%s}' % ','.join(self.tikz_libraries))
+    def _compile_document(self, header, code_list):
+        pictures = '\n'.join(
+            _TIKZPICTURE_TEMPLATE.format(
+                scale=self.scale, body=self._indent(code))
+            for code in code_list)
 
-        if self.preamble is not None:
-            # the strip allows users to string-escape spacing
-            tex.append('%s' % self.preamble.strip("'\""))
+        return _TEX_TEMPLATE.format(
+            header=header, preamble=self._preamble_tex, pictures=pictures)
 
-        tex.append('\\begin{document}\n'
-                   '\\begin{tikzpicture}[scale=%(scale)s]' % kwargs)
+    @staticmethod
+    def _indent(code):
+        # splitlines() handles any line ending, so a cell with \r\n endings
+        # does not leave stray \r characters in the document
+        return textwrap.indent('\n'.join(code.rstrip().splitlines()), '    ')
 
-        tex.append('\n'.join([
-            '    %s' % line.strip()
-            for line in self.code.split(os.linesep)
-        ]))
+    def generate_plots(self, compiled_code):
+        display_data = []
 
-        tex.append('\\end{tikzpicture}\n'
-                   '\\end{document}')
+        # Identical LaTeX sources produce identical images, so a previous
+        # result can be published without running LaTeX at all.
+        cache_key = self._cache_key(compiled_code)
+        image = self._lookup_cache(cache_key)
+
+        if image is None:
+            if self._engine == 'latex':
+                image = self._compile_image(compiled_code, 'latex', publish_log=False)
+                if image is None:
+                    # DVI output can not include PNG or PDF graphics and has
+                    # no pdfTeX primitives, so retry through a PDF and pdf2svg
+                    image = self._compile_image(
+                        self.compile_tikz_template(engine='pdflatex'), 'pdflatex')
+            else:
+                image = self._compile_image(compiled_code, self._engine)
 
-        return str('\n').join(tex)
+            if image is None:
+                return display_data
+            self._store_in_cache(cache_key, image)
 
-    def generate_plots(self, compiled_code):
-        display_data = []
-        with make_tempdir() as plot_dir:
-            latex_log = run_latex(compiled_code, plot_dir, self.encoding)
+        display_data.append((self._key, self._publish_image(image)))
+        self._save_if_requested(image)
+
+        return display_data
+
+    def _compile_image(self, compiled_code, engine, publish_log=True):
+        """Run `engine` on the LaTeX source and convert its output to the
+        plot format. Returns the image data, or None if no image could be
+        generated.
+        """
+        fmt_dir = None
+        if self.format_provider is not None:
+            fmt_dir = self.format_provider(self.compile_tikz_header(engine=engine), engine)
+
+        with self._plot_dir() as plot_dir:
+            latex_log = run_latex(compiled_code, plot_dir, self.encoding, fmt_dir, engine)
 
             # If the latex error log exists, then image generation has failed.
             # Publish error log and return immediately
             if latex_log:
-                publish_display_data(
-                    source=self._key,
-                    data={'text/plain': latex_log})
-            else:
-                _convert_img_format(plot_dir, self.plot_format)
-
-                image_filename = "%s/tikz.%s" % (plot_dir, self.plot_format)
-                img = self._publish_image(image_filename)
-                if img is not None:
-                    display_data.append((self._key, img))
+                if publish_log:
+                    publish_display_data(
+                        source=self._key,
+                        data={'text/plain': latex_log})
+                return None
+
+            _convert_img_format(
+                plot_dir, self.plot_format, (self.width, self.height), engine)
+            return self._read_image("%s/tikz.%s" % (plot_dir, self.plot_format))
+
+    def generate_batch_plots(self, code_list):
+        # Pictures are cached under the same key as when compiled on their
+        # own with pdflatex, only the remaining ones are compiled together.
+        cache_keys = [self._cache_key(self.compile_tikz_template(code, engine='pdflatex'))
+                      for code in code_list]
+        images = [self._lookup_cache(cache_key) for cache_key in cache_keys]
+        missing = [i for i, image in enumerate(images) if image is None]
 
-                self._save_if_requested(image_filename)
+        display_data = []
+        if missing:
+            compiled_code = self.compile_tikz_batch_template(
+                [code_list[i] for i in missing])
+
+            fmt_dir = None
+            if self.format_provider is not None:
+                fmt_dir = self.format_provider(self.compile_tikz_header(batch=True))
+
+            with self._plot_dir() as plot_dir:
+                latex_log = run_latex(compiled_code, plot_dir, self.encoding, fmt_dir)
+                if latex_log:
+                    # the cached pictures are still published below
+                    publish_display_data(
+                        source=self._key,
+                        data={'text/plain': latex_log})
+                else:
+                    image_filenames = _convert_pdf_pages(
+                        plot_dir, self.plot_format, range(1, len(missing) + 1),
+                        (self.width, self.height))
+                    for i, image_filename in zip(missing, image_filenames):
+                        images[i] = self._read_image(image_filename)
+                        if images[i] is not None:
+                            self._store_in_cache(cache_keys[i], images[i])
+
+        for i, image in enumerate(images):
+            if image is not None:
+                display_data.append((self._key, self._publish_image(image)))
+                self._save_if_requested(image, index=i + 1)
 
         return display_data
 
-    def _publish_image(self, image_filename):
-        try:
-            with open(image_filename, 'rb') as f:
-                image = f.read()
+    @contextlib.contextmanager
+    def _plot_dir(self):
+        """Yields the directory to run LaTeX in: the cleaned up `workdir` if
+        one is given, else a new temporary directory.
+        """
+        if self.workdir is None:
+            with make_tempdir() as plot_dir:
+                yield plot_dir
+        else:
+            clean_workdir(self.workdir)
+            yield self.workdir
 
-            plot_mime_type = get_mime_type(self.plot_format)
-            if self.plot_format == 'svg':
-                image = _fix_gnuplot_svg_size(image, size=(self.width, self.height))
+    def _cache_key(self, compiled_code):
+        """Returns the key of the given LaTeX source in the image caches, or
+        None if caching is disabled.
+        """
+        if not self.use_cache:
+            return None
+
+        # The size is not always part of the source: PDF pages rendered with
+        # pdfium, and the pages of a batch, are scaled after the LaTeX run.
+        # The encoding decides the bytes LaTeX actually reads.
+        key_data = '\n'.join([
+            compiled_code, self.plot_format, '%sx%s' % (self.width, self.height),
+            self.encoding])
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def _cache_path(self, cache_key):
+        return os.path.join(self.cache_dir, '%s.%s' % (cache_key, self.plot_format))
+
+    def _lookup_cache(self, cache_key):
+        """Returns the cached image data for `cache_key`, looking in memory
+        first and then on disk, or None if the image has to be compiled.
+        """
+        if cache_key is None:
+            return None
+
+        if self.memcache is not None:
+            image = self.memcache.get(cache_key)
+            if image is not None:
+                return image
 
-            return {plot_mime_type: image}
+        cache_path = self._cache_path(cache_key)
+        if not os.path.isfile(cache_path):
+            return None
+
+        image = self._read_image(cache_path)
+        if image is not None and self.memcache is not None:
+            self.memcache.put(cache_key, image)
+        return image
+
+    def _store_in_cache(self, cache_key, image):
+        """Store a freshly generated image in the memory and disk caches."""
+        if cache_key is None:
+            return
+
+        if self.memcache is not None:
+            self.memcache.put(cache_key, image)
+
+        cache_path = self._cache_path(cache_key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write under a temporary name first, so that an interrupted write
+            # never leaves a truncated image behind for later cache hits
+            partial_path = '%s.%d.part' % (cache_path, os.getpid())
+            pathlib.Path(partial_path).write_bytes(image)
+            os.replace(partial_path, cache_path)
+        except OSError as e:
+            print("Could not cache image:", e, file=sys.stderr)
+
+    def _read_image(self, image_filename):
+        try:
+            return pathlib.Path(image_filename).read_bytes()
         except IOError:
             print("No image generated.", file=sys.stderr)
             return None
 
-    def _save_if_requested(self, image_filename):
-        """Copy output file if requested."""
+    def _publish_image(self, image):
+        # raster images are published as read, only SVGs need patching
+        if self.plot_format == 'svg':
+            image = _fix_gnuplot_svg_size(image, size=(self.width, self.height))
+
+        return {get_mime_type(self.plot_format): image}
+
+    def _save_if_requested(self, image, index=None):
+        """Write the image data to a file if requested. For batches, `index`
+        is the number of the picture, which is inserted before the file
+        extension.
+        """
         if self.img_save_path is not None:
-            shutil.copy(image_filename, self.img_save_path)
+            img_save_path = self.img_save_path
+            if index is not None:
+                root, ext = os.path.splitext(img_save_path)
+                img_save_path = '%s-%d%s' % (root, index, ext)
+            pathlib.Path(img_save_path).write_bytes(image)
 
 
 __doc__ = __doc__.format(
     TIKZ_DOC=' ' * 8 + TikzMagics.tikz.__doc__,
+    TIKZ_BATCH_DOC=' ' * 8 + TikzMagics.tikz_batch.__doc__,
 )
 
 